@@ -0,0 +1,90 @@
+import os
+import sys
+import time
+import shutil
+import asyncio
+import resource
+if sys.version_info >= (3, 11):
+    from asyncio import TaskGroup
+else:
+    from taskgroup import TaskGroup
+
+import pulsectl_asyncio
+
+from pulse_mcu import np, PulseModel, PulseView, PCMMeter, FP16
+
+SECONDS = 10
+
+class NullPanel:
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+def cpu():
+    # parec runs as a child, so count it too (it's only tallied once reaped)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+# Peak detection (and parec's resampling/remapping) happens in the server, not
+# here, so its CPU time has to be counted too.
+SERVER_PROCS = {
+        'pulseaudio': ['pulseaudio'],
+        'pipewire': ['pipewire', 'pipewire-pulse'],
+}
+async def server_pids(pulse):
+    info = await pulse.server_info()
+    names = SERVER_PROCS['pipewire' if 'pipewire' in info.server_name.lower() else 'pulseaudio']
+    pids = []
+    for pid in filter(str.isdigit, os.listdir('/proc')):
+        try:
+            with open(f'/proc/{pid}/comm') as f:
+                if f.read().strip() in names:
+                    pids.append(pid)
+        except OSError:
+            pass
+    if not pids:
+        print('could not find server process', names, '- server CPU will read as 0')
+    return pids
+
+def server_cpu(pids):
+    total = 0
+    for pid in pids:
+        with open(f'/proc/{pid}/stat') as f:
+            # comm may have spaces, so count fields from after it; utime and stime are 14 and 15
+            fields = f.read().rsplit(')', 1)[1].split()
+        total += int(fields[11]) + int(fields[12])
+    return total / os.sysconf('SC_CLK_TCK')
+
+async def bench(pulse, pcm, width, pids):
+    model = PulseModel(pulse, None)
+    await model.update()
+    active = min(width, len(model.streams))
+    before, server_before = cpu(), server_cpu(pids)
+    async with TaskGroup() as tg:
+        view = PulseView(model, NullPanel(), tg, width)
+        if pcm:
+            view.meter = PCMMeter(view, tg)
+        await asyncio.sleep(SECONDS)
+        for sidx in range(width):
+            await view.set_strip(sidx, None)
+        if view.meter is not None:
+            view.meter.close()
+    used, server_used = cpu() - before, server_cpu(pids) - server_before
+    name = 'pcm' if pcm else 'peak'
+    per_strip = 100 / SECONDS / max(active, 1)
+    print(f'{name}: {active} strips in {SECONDS}s; '
+          f'client {used:.3f}s CPU ({used * per_strip:.2f}% of a core per strip), '
+          f'server {server_used:.3f}s CPU ({server_used * per_strip:.2f}% of a core per strip)')
+
+async def main():
+    async with pulsectl_asyncio.PulseAsync('pulse-mcu-bench') as pulse:
+        pids = await server_pids(pulse)
+        await bench(pulse, False, FP16.STRIPS, pids)
+        if np is None:
+            print('skipping pcm: needs numpy')
+        elif shutil.which('parec') is None:
+            print('skipping pcm: needs parec on PATH')
+        else:
+            await bench(pulse, True, FP16.STRIPS, pids)
+
+if __name__ == '__main__':
+    asyncio.run(main())
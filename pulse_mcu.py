@@ -4,11 +4,14 @@
 
 import sys
 import time
+import argparse
 import asyncio
 import random
 import traceback
 import itertools
 import math
+import json
+import shutil
 from enum import Enum, IntEnum
 from pprint import pprint
 if sys.version_info >= (3, 11):
@@ -16,6 +19,11 @@ if sys.version_info >= (3, 11):
 else:
     from taskgroup import TaskGroup
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 import pulsectl_asyncio
 from pulsectl_asyncio.pulsectl_async import PulseEventTypeEnum, PulseEventFacilityEnum, PulseIndexError
 import rtmidi2
@@ -52,6 +60,12 @@ class DecibelRange:
             return 0
         return self.fullscale_to_lin(self.lower + self.range * unit)
 
+    # Same as unit_from_lin, but over a whole numpy array at once (for the PCM meters).
+    def units_from_lin(self, lin):
+        with np.errstate(divide='ignore'):
+            db = np.clip(60 * np.log10(np.abs(lin)), self.lower, self.upper)
+        return (db - self.lower) / self.range
+
 DecibelRange.DEFAULT = DecibelRange()
 DecibelRange.METER = DecibelRange(-120, 0)
 
@@ -73,6 +87,33 @@ class PulseMonitor:
         print(f'open {self.source.name} {self.index}')
         return pulse.subscribe_peak_sample(self.source.name, stream_idx=self.index, rate=rate)
 
+    # pulsectl doesn't expose recording, so lean on parec for the raw float PCM.
+    # The stream name makes PulseModel ignore it like any other peak detector.
+    async def record(self, channels, rate, frames):
+        channels = min(channels, self.source.channel_count)
+        args = ['parec', '--raw', '--format=float32le', f'--rate={rate}',
+                f'--channels={channels}', f'--latency={frames * channels * 4}',
+                '--client-name=pulse-mcu', '--stream-name=Peak detect',
+                '-d', self.source.name]
+        if self.index is not None:
+            args.append(f'--monitor-stream={self.index}')
+        print(f'record {self.source.name} {self.index}')
+        proc = await asyncio.create_subprocess_exec(*args,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        try:
+            while True:
+                data = await proc.stdout.readexactly(frames * channels * 4)
+                yield np.frombuffer(data, dtype='<f4').reshape(frames, channels)
+        except asyncio.IncompleteReadError:
+            # parec quit on its own (bad device, stream went away...); say why
+            await proc.wait()
+            err = (await proc.stderr.read()).decode(errors='replace').strip()
+            print(f'record {self.source.name} {self.index} ended: parec exited {proc.returncode}', err)
+        finally:
+            if proc.returncode is None:
+                proc.kill()
+            await proc.wait()
+
 class PulseStream:
     def __init__(self, model, info, kind, monitor = None):
         self.model = model
@@ -87,6 +128,9 @@ class PulseStream:
     def subscribe_sample_peak(self, rate=5):
         return self.monitor.subscribe_sample_peak(self.model.pulse, rate)
 
+    def record(self, channels, rate, frames):
+        return self.monitor.record(channels, rate, frames)
+
     INFO_FUNCS = {
             StreamKind.HARD_IN: 'source_info',
             StreamKind.HARD_OUT: 'sink_info',
@@ -119,11 +163,146 @@ class PulseStream:
         await self.model.pulse.mute(self.info, value)
         await self.update()
 
+class PageRule:
+    def __init__(self, page, pos, match, slot=None):
+        self.page, self.pos = page, pos
+        where = f'page {page + 1} rule {pos + 1}'
+        if not isinstance(match, dict):
+            raise ValueError(f'{where}: match should be an object, not {match!r}')
+        self.match = dict(match)
+        # Names and props are always strings, so nothing else could ever match
+        for field, value in self.match.items():
+            if not isinstance(value, str):
+                raise ValueError(f'{where}: {field} should be a string, not {value!r}')
+        kind = self.match.get('kind')
+        if kind is not None and kind not in StreamKind.__members__:
+            raise ValueError(f'{where}: unknown kind {kind!r}, expected one of {", ".join(StreamKind.__members__)}')
+        if slot is not None and (not isinstance(slot, int) or isinstance(slot, bool) or slot < 0):
+            raise ValueError(f'{where}: slot should be a strip number from 0, not {slot!r}')
+        self.slot = slot
+        # The fields this rule looks at, and the values it wants for them
+        self.sig = tuple(sorted(self.match))
+        self.values = tuple(self.match[field] for field in self.sig)
+
+    def __repr__(self):
+        return f'<PageRule page {self.page} #{self.pos} {self.match!r} slot {self.slot!r}>'
+
+class UserPages:
+    '''User fader pages, defined by rules over stream props.
+
+    Each rule matches when all of its conditions do: "kind" against the
+    StreamKind name, "name" against the stream name, and anything else against
+    that key of the proplist. Rules are grouped by the set of fields they look
+    at and keyed by the values they want, so matching a stream is one lookup
+    per distinct set of fields, however many rules there are. Page membership
+    is kept up to date as streams come and go, so laying out a page never
+    rescans the streams.
+    '''
+    def __init__(self, pages=()):
+        self.by_sig = {}  # sorted fields -> {their values: [PageRule]}
+        self.fields = []  # every field any rule looks at, in key order
+        self.members = []  # per page: stream index -> PageRule, in order of arrival
+        self.keys = {}  # stream index -> the values of self.fields last matched
+        self.streams = {}
+        for page in pages:
+            self.add_page(page.get('rules', []))
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def __len__(self):
+        return len(self.members)
+
+    def add_page(self, rules):
+        page = len(self.members)
+        self.members.append({})
+        for pos, rule in enumerate(rules):
+            rule = PageRule(page, pos, rule.get('match', {}), rule.get('slot'))
+            self.by_sig.setdefault(rule.sig, {}).setdefault(rule.values, []).append(rule)
+            for field in rule.sig:
+                if field not in self.fields:
+                    self.fields.append(field)
+        # The new rules might match streams we already have
+        for stream in list(self.streams.values()):
+            self.keys.pop(stream.info.index, None)
+            self.update(stream)
+
+    @staticmethod
+    def field(stream, field):
+        if field == 'kind':
+            return stream.kind.name
+        if field == 'name':
+            return stream.get_name()
+        return stream.info.proplist.get(field)
+
+    def match(self, stream, key):
+        values = dict(zip(self.fields, key))
+        best = {}
+        for sig, rules in self.by_sig.items():
+            for rule in rules.get(tuple(values[field] for field in sig), ()):
+                if rule.page not in best or rule.pos < best[rule.page].pos:
+                    best[rule.page] = rule
+        return best
+
+    def update(self, stream):
+        '''Rematch a new or changed stream; returns the pages that changed.'''
+        index = stream.info.index
+        self.streams[index] = stream
+        key = tuple(self.field(stream, field) for field in self.fields)
+        if self.keys.get(index) == key:
+            return set()
+        self.keys[index] = key
+        best = self.match(stream, key)
+        changed = set()
+        for page, members in enumerate(self.members):
+            rule = best.get(page)
+            if members.get(index) is rule:
+                continue
+            changed.add(page)
+            if rule is None:
+                del members[index]
+            else:
+                members[index] = rule
+        return changed
+
+    def remove(self, index):
+        self.streams.pop(index, None)
+        self.keys.pop(index, None)
+        changed = set()
+        for page, members in enumerate(self.members):
+            if members.pop(index, None) is not None:
+                changed.add(page)
+        return changed
+
+    def sync(self, streams):
+        for index in [index for index in self.streams if index not in streams]:
+            self.remove(index)
+        for stream in streams.values():
+            self.update(stream)
+
+    def layout(self, page, width):
+        slots = [None] * width
+        unpinned = []
+        for index, rule in self.members[page].items():
+            stream = self.streams[index]
+            if rule.slot is not None and 0 <= rule.slot < width and slots[rule.slot] is None:
+                slots[rule.slot] = stream
+            else:
+                unpinned.append(stream)
+        unpinned = iter(unpinned)
+        for sidx, stream in enumerate(slots):
+            if stream is None:
+                slots[sidx] = next(unpinned, None)
+        return slots
+
 class PulseModel:
-    def __init__(self, pulse, view):
+    def __init__(self, pulse, view, pages=None):
         self.pulse = pulse
         self.view = view
         self.streams = {}
+        self.pages = pages if pages is not None else UserPages()
 
     async def initialize(self, tg):
         self.tg = tg
@@ -156,6 +335,7 @@ class PulseModel:
             mon = await self.pulse.source_info(sink.monitor_source)
             self.streams[snk.index] = PulseStream(self, snk, StreamKind.APP_OUT,
                 PulseMonitor(mon, snk.index))
+        self.pages.sync(self.streams)
     INFO_SOURCE = {
             PulseEventFacilityEnum.sink: 'sink_info',
             PulseEventFacilityEnum.sink_input: 'sink_input_info',
@@ -170,9 +350,21 @@ class PulseModel:
                 await self.update()
                 await self.view.refresh()
             else:
-                if ev.index not in self.streams:
+                stream = self.streams.get(ev.index)
+                if stream is None:
                     # We're not monitoring this because it's probably a peaker. Ignore.
                     continue
+                if self.pages.fields:
+                    # Props can change what pages a stream is on, even if it's not shown
+                    await stream.update()
+                    if not stream.closed:
+                        changed = self.pages.update(stream)
+                        # Only worth redoing every strip if it's the page on show
+                        if self.view.USER_VIEWS.get(self.view.view) in changed:
+                            await self.view.refresh()
+                            continue
+                    await self.view.stream_update(ev.index, fetch=False)
+                    continue
                 await self.view.stream_update(ev.index)
 
 class PulseStrip:
@@ -199,6 +391,15 @@ class PulseView:
         APP_IN = 3
         APP_OUT = 4
         ALL = 5
+        USER_1 = 6
+        USER_2 = 7
+        USER_3 = 8
+
+    USER_VIEWS = {
+            View.USER_1: 0,
+            View.USER_2: 1,
+            View.USER_3: 2,
+    }
 
     PEAK_RATE = 25
 
@@ -210,16 +411,25 @@ class PulseView:
         self.view = self.View.ALL
         self.init_task = self.tg.create_task(self.set_view(self.View.ALL))
         self.peakers = {}
+        self.meter = None  # if set (e.g., a PCMMeter), replaces the peakers
 
-    async def stream_update(self, index):
+    async def stream_update(self, index, fetch=True):
+        # fetch=False when the caller has just updated the stream itself
         for sidx, strip in enumerate(self.strips):
             if strip and strip.index == index:
-                await strip.stream.update()
+                if fetch:
+                    await strip.stream.update()
                 await self.send_strip(sidx, strip)
 
     async def set_view(self, view):
+        page = self.USER_VIEWS.get(view)
+        if page is not None and page >= len(self.model.pages):
+            print('no user page', page + 1)
+            return
         self.view = view
-        if view != self.View.ALL:
+        if page is not None:
+            streams = self.model.pages.layout(page, len(self.strips))
+        elif view != self.View.ALL:
             streams = [stream for stream in self.model.streams.values() if stream.kind._value_ == view._value_]
         else:
             streams = list(self.model.streams.values())
@@ -247,6 +457,10 @@ class PulseView:
     async def set_strip(self, sidx, strip):
         print('set_strip', sidx, strip)
         self.strips[sidx] = strip
+        if self.meter is not None:
+            self.meter.set_strip(sidx, strip)
+            await self.send_strip(sidx, strip)
+            return
         pkinfo = self.peakers.get(sidx)
         if strip is None or (pkinfo is None and strip is not None) or (pkinfo is not None and pkinfo[1] != strip.stream.info.index):
             if pkinfo is not None:
@@ -275,6 +489,121 @@ class PulseView:
             return
         await strip.stream.set_is_muted(not strip.stream.get_is_muted())
 
+class PCMMeter:
+    '''Meters strips from raw PCM instead of Pulse's peak detection.
+
+    Each strip records blocks of float samples from its monitor and only
+    copies them into its row of a shared buffer. Every tick, the buffered
+    samples of all strips are reduced to per-channel peak, RMS, and clip
+    counts in one batched numpy pass, so nothing between ticks goes
+    unmeasured. (If a row would overflow before the tick, say because the
+    loop is busy, the same pass runs early and its totals carry over.)
+    '''
+    CHANNELS = 2
+    RATE = 48000
+    FRAMES = 1024  # per block; about 21ms at RATE
+    TICK = 1 / PulseView.PEAK_RATE
+    BUFFER_FRAMES = 4 * FRAMES  # per strip; about two ticks' worth
+    CLIP = 1.0
+
+    def __init__(self, view, tg):
+        width = len(view.strips)
+        self.view = view
+        self.tg = tg
+        # Samples since the last pass; rows stay zeroed past their fill
+        self.buffer = np.zeros((width, self.BUFFER_FRAMES, self.CHANNELS), dtype=np.float32)
+        self.fill = np.zeros(width, dtype=np.int64)
+        # Totals since the last tick
+        self.acc_peak = np.zeros((width, self.CHANNELS), dtype=np.float32)
+        self.acc_sumsq = np.zeros((width, self.CHANNELS), dtype=np.float64)
+        self.acc_frames = np.zeros(width, dtype=np.int64)
+        self.acc_clips = np.zeros((width, self.CHANNELS), dtype=np.int64)
+        # What was measured at the last tick
+        self.peak = np.zeros((width, self.CHANNELS), dtype=np.float32)
+        self.rms = np.zeros((width, self.CHANNELS), dtype=np.float32)
+        self.clips = np.zeros((width, self.CHANNELS), dtype=np.int64)
+        self.recorders = {}
+        self.task = tg.create_task(self.ticker())
+
+    def reset(self, sidx):
+        self.buffer[sidx] = self.fill[sidx] = 0
+        self.acc_peak[sidx] = self.acc_sumsq[sidx] = self.acc_frames[sidx] = self.acc_clips[sidx] = 0
+        self.peak[sidx] = self.rms[sidx] = self.clips[sidx] = 0
+
+    def set_strip(self, sidx, strip):
+        rcinfo = self.recorders.get(sidx)
+        if rcinfo is not None and strip is not None and rcinfo[1] == strip.stream.info.index:
+            return
+        if rcinfo is not None:
+            rcinfo[0].cancel()
+            del self.recorders[sidx]
+        self.reset(sidx)
+        if strip is not None:
+            self.recorders[sidx] = (self.tg.create_task(self.recorder(sidx, strip)), strip.stream.info.index)
+
+    def close(self):
+        for sidx in list(self.recorders):
+            self.set_strip(sidx, None)
+        self.task.cancel()
+
+    def levels(self, sidx):
+        return {'peak': self.peak[sidx].tolist(), 'rms': self.rms[sidx].tolist(), 'clips': self.clips[sidx].tolist()}
+
+    async def recorder(self, sidx, strip):
+        try:
+            async for block in strip.stream.record(self.CHANNELS, self.RATE, self.FRAMES):
+                frames, chans = block.shape
+                if self.fill[sidx] + frames > self.BUFFER_FRAMES:
+                    self.fold()
+                # Mono (or narrower) streams just leave the other channels silent
+                fill = self.fill[sidx]
+                self.buffer[sidx, fill:fill + frames, :chans] = block
+                self.fill[sidx] += frames
+        finally:
+            # If parec quit on its own, forget it so set_strip can start another,
+            # and don't leave the meter stuck where it was
+            rcinfo = self.recorders.get(sidx)
+            if rcinfo is not None and rcinfo[0] is asyncio.current_task():
+                del self.recorders[sidx]
+                self.reset(sidx)
+                if self.view.panel is not None:
+                    self.view.panel.set_meter(sidx, FP16.MeterKind.BAR, 0)
+
+    def fold(self):
+        mask = self.fill > 0
+        if not mask.any():
+            return
+        # Past each row's fill is zeros, which don't move any of these
+        samples = np.abs(self.buffer[mask])
+        self.acc_peak[mask] = np.maximum(self.acc_peak[mask], samples.max(axis=1))
+        self.acc_sumsq[mask] += np.square(samples, dtype=np.float64).sum(axis=1)
+        self.acc_clips[mask] += np.count_nonzero(samples >= self.CLIP, axis=1)
+        self.acc_frames[mask] += self.fill[mask]
+        self.buffer[mask] = 0
+        self.fill[mask] = 0
+
+    def measure(self):
+        self.fold()
+        mask = self.acc_frames > 0
+        if not mask.any():
+            return mask
+        self.peak[mask] = self.acc_peak[mask]
+        self.rms[mask] = np.sqrt(self.acc_sumsq[mask] / self.acc_frames[mask, None])
+        self.clips[mask] += self.acc_clips[mask]
+        self.acc_peak[mask] = self.acc_sumsq[mask] = self.acc_frames[mask] = self.acc_clips[mask] = 0
+        return mask
+
+    async def ticker(self):
+        while True:
+            await asyncio.sleep(self.TICK)
+            mask = self.measure()
+            panel = self.view.panel
+            if panel is None:
+                continue
+            units = DecibelRange.METER.units_from_lin(self.peak.max(axis=1))
+            for sidx in np.flatnonzero(mask):
+                panel.set_meter(sidx, FP16.MeterKind.BAR, units[sidx])
+
 def lrange(base, width):
     return range(base, base + width)
 
@@ -505,9 +834,11 @@ class FP16:
 
     def handle_solo(self, strip, selected):
         print('handle_solo', strip, selected)
-        strip = self.view.strips[strip]
+        sidx, strip = strip, self.view.strips[strip]
         if selected and strip:
             pprint(strip.stream.info.proplist)
+            if self.view.meter is not None:
+                pprint(self.view.meter.levels(sidx))
 
     def handle_mute(self, strip, selected):
         print('handle_mute', strip, selected)
@@ -527,6 +858,10 @@ class FP16:
             Button.BUS: PulseView.View.APP_IN,
             Button.VCA: PulseView.View.APP_OUT,
             Button.ALL: PulseView.View.ALL,
+            # No shift-chords yet, so these act as their shifted "User" labels
+            Button.TOUCH: PulseView.View.USER_1,
+            Button.WRITE: PulseView.View.USER_2,
+            Button.READ: PulseView.View.USER_3,
     }
     def handle_button(self, button, selected):
         print('handle_button', button, selected)
@@ -539,12 +874,24 @@ class FP16:
             ))
             return
 
-async def main():
+async def main(args):
+    pages = None
+    if args.pages is not None:
+        pages = UserPages.load(args.pages)
+        if len(pages) > len(PulseView.USER_VIEWS):
+            print(f'{args.pages} has {len(pages)} pages, but only the first {len(PulseView.USER_VIEWS)} have buttons')
     async with pulsectl_asyncio.PulseAsync('pulse-mcu') as pulse:
         async with TaskGroup() as tg:
-            model = PulseModel(pulse, None)
+            model = PulseModel(pulse, None, pages)
             view = PulseView(model, None, tg, FP16.STRIPS)
             model.view = view
+            if args.pcm_meters:
+                if np is None:
+                    print('--pcm-meters needs numpy; falling back to peak detection')
+                elif shutil.which('parec') is None:
+                    print('--pcm-meters needs parec on PATH; falling back to peak detection')
+                else:
+                    view.meter = PCMMeter(view, tg)
             print('model start')
             await model.initialize(tg)
 
@@ -570,4 +917,7 @@ async def main():
 
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description='Control Pulse streams from a FaderPort 16.')
+    parser.add_argument('--pages', metavar='PATH', help='JSON file of user fader pages (see README)')
+    parser.add_argument('--pcm-meters', action='store_true', help='meter from raw PCM (needs numpy and parec)')
+    asyncio.run(main(parser.parse_args()))